@@ -158,13 +158,21 @@ class Merkle(object):
 class MerkleCache(object):
     '''A cache to calculate merkle branches efficiently.'''
 
-    def __init__(self, merkle, source, length):
-        '''Initialise a cache of length hashes taken from source.'''
+    def __init__(self, merkle, source, length, level=None):
+        '''Initialise a cache of length hashes taken from source.
+
+        If given, level is a previously calculated level of complete
+        segments of a prefix of the same hashes, as found in the level
+        attribute of a cache of the same depth.  Only the hashes after
+        it are taken from source.'''
         self.merkle = merkle
         self.source = source
         self.length = length
         self.depth_higher = merkle.tree_depth(length) // 2
-        self.level = self._level(source.hashes(0, length))
+        level = list(level or [])
+        start = len(level) << self.depth_higher
+        assert start <= length
+        self.level = level + self._level(source.hashes(start, length - start))
 
     def _segment_length(self):
         return 1 << self.depth_higher
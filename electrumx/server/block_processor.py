@@ -11,20 +11,38 @@
 
 import array
 import asyncio
-from struct import pack, unpack
+from concurrent.futures import ThreadPoolExecutor
+from struct import pack, unpack, Struct
 import time
 from functools import partial
+from itertools import islice
+from sys import getsizeof
 
 import electrumx
 from electrumx.server.daemon import DaemonError
 from electrumx.lib.hash import hash_to_hex_str, HASHX_LEN
 from electrumx.lib.merkle import Merkle, MerkleCache
+from electrumx.lib.tx import TxInput
 from electrumx.lib.util import chunks, formatted_time, class_logger
 import electrumx.server.db
 
 
 RAW_BLOCKS, PREFETCHER_CAUGHT_UP, REORG_CHAIN = range(3)
 
+# Packed tx output indices; indexing this is several times faster
+# than packing
+PACKED_IDX = tuple(pack('<H', idx) for idx in range(65536))
+# The prev_idx of a coinbase input.  The is_coinbase property of a tx
+# is slow to compute the first time, so it is only tested if the first
+# input has this prev_idx, which no other input can
+COINBASE_IDX = TxInput.MINUS_1
+# Packs a UTXO cache value (hashX, tx_num, value) in one allocation
+pack_utxo_value = Struct(f'<{HASHX_LEN:d}sIQ').pack
+# Sizes of the bytes objects of a UTXO cache entry, and the average
+# size of the "h" and "u" keys in db_deletes
+UTXO_ITEM_SIZE = getsizeof(bytes(34)) + getsizeof(bytes(HASHX_LEN + 12))
+DB_DELETE_SIZE = (getsizeof(bytes(11)) + getsizeof(bytes(HASHX_LEN + 7))) // 2
+
 
 class Prefetcher(object):
     '''Prefetches blocks (in the forward direction only).'''
@@ -43,7 +61,10 @@ class Prefetcher(object):
         # little effect on sync time.
         self.cache_size = 0
         self.min_cache_size = 10 * 1024 * 1024
-        # This makes the first fetch be 10 blocks
+        # The min cache size is grown up to this if the block
+        # processor is kept waiting for blocks
+        self.max_cache_size = 100 * 1024 * 1024
+        # This makes the first fetch be 5 blocks
         self.ave_size = self.min_cache_size // 10
 
     async def main_loop(self):
@@ -63,6 +84,17 @@ class Prefetcher(object):
         if self.cache_size < self.min_cache_size:
             self.refill_event.set()
 
+    def starved(self):
+        '''Called by block processor when it ran out of queued blocks
+        before catching up.  Grow the cache so more blocks are fetched
+        while it is busy.'''
+        if not self.caught_up and self.min_cache_size < self.max_cache_size:
+            self.min_cache_size = min(self.min_cache_size * 2,
+                                      self.max_cache_size)
+            self.logger.info('prefetch cache size raised to {:,d}MB'
+                             .format(self.min_cache_size // (1024 * 1024)))
+            self.refill_event.set()
+
     async def reset_height(self, height):
         '''Reset to prefetch blocks from the block processor's height.
 
@@ -87,49 +119,81 @@ class Prefetcher(object):
     async def _prefetch_blocks(self):
         '''Prefetch some blocks and put them on the queue.
 
-        Repeats until the queue is full or caught up.
+        Repeats until the queue is full or caught up.  Two batches of
+        blocks are requested from the daemon at a time so that the
+        round trip of one overlaps with the transfer of the other.
         '''
         daemon = self.daemon
         daemon_height = await daemon.height()
         async with self.semaphore:
-            while self.cache_size < self.min_cache_size:
-                # Try and catch up all blocks but limit to room in cache.
-                # Constrain fetch count to between 0 and 500 regardless;
-                # testnet can be lumpy.
-                cache_room = self.min_cache_size // self.ave_size
-                count = min(daemon_height - self.fetched_height, cache_room)
-                count = min(500, max(count, 0))
-                if not count:
-                    if not self.caught_up:
-                        self.caught_up = True
-                        await self.queue.put((PREFETCHER_CAUGHT_UP, ))
-                    return False
-
-                first = self.fetched_height + 1
-                hex_hashes = await daemon.block_hex_hashes(first, count)
-                if self.caught_up:
-                    self.logger.info('new block height {:,d} hash {}'
-                                     .format(first + count-1, hex_hashes[-1]))
-                blocks = await daemon.raw_blocks(hex_hashes)
-
-                assert count == len(blocks)
-
-                # Special handling for genesis block
-                if first == 0:
-                    blocks[0] = self.coin.genesis_block(blocks[0])
-                    self.logger.info('verified genesis block with hash {}'
-                                     .format(hex_hashes[0]))
-
-                # Update our recent average block size estimate
-                size = sum(len(block) for block in blocks)
-                if count >= 10:
-                    self.ave_size = size // count
-                else:
-                    self.ave_size = (size + (10 - count) * self.ave_size) // 10
-
-                await self.queue.put((RAW_BLOCKS, blocks, first))
-                self.cache_size += size
-                self.fetched_height += count
+            fetches = []
+            fetch_height = self.fetched_height
+            fetch_size = 0
+            try:
+                while True:
+                    # Try and catch up all blocks but limit to room in
+                    # cache, fetching at least one block if there is room.
+                    # Constrain fetch count to between 0 and 500
+                    # regardless; testnet can be lumpy.
+                    while (len(fetches) < 2 and self.cache_size + fetch_size
+                           < self.min_cache_size):
+                        cache_room = max(
+                            self.min_cache_size // self.ave_size // 2, 1)
+                        count = min(daemon_height - fetch_height, cache_room)
+                        count = min(500, max(count, 0))
+                        if not count:
+                            break
+
+                        first = fetch_height + 1
+                        hex_hashes = await daemon.block_hex_hashes(first,
+                                                                   count)
+                        if self.caught_up:
+                            self.logger.info('new block height {:,d} hash {}'
+                                             .format(first + count - 1,
+                                                     hex_hashes[-1]))
+                        fetch = asyncio.ensure_future(
+                            daemon.raw_blocks(hex_hashes))
+                        est_size = count * self.ave_size
+                        fetches.append((fetch, first, hex_hashes, est_size))
+                        fetch_height += count
+                        fetch_size += est_size
+
+                    if not fetches:
+                        break
+
+                    fetch, first, hex_hashes, est_size = fetches.pop(0)
+                    blocks = await fetch
+                    fetch_size -= est_size
+                    count = len(hex_hashes)
+
+                    assert count == len(blocks)
+
+                    # Special handling for genesis block
+                    if first == 0:
+                        blocks[0] = self.coin.genesis_block(blocks[0])
+                        self.logger.info('verified genesis block with hash {}'
+                                         .format(hex_hashes[0]))
+
+                    # Update our recent average block size estimate
+                    size = sum(len(block) for block in blocks)
+                    if count >= 10:
+                        self.ave_size = size // count
+                    else:
+                        self.ave_size = ((size + (10 - count) * self.ave_size)
+                                         // 10)
+
+                    await self.queue.put((RAW_BLOCKS, blocks, first))
+                    self.cache_size += size
+                    self.fetched_height += count
+            finally:
+                for fetch, *rest in fetches:
+                    fetch.cancel()
+
+            if self.fetched_height >= daemon_height:
+                if not self.caught_up:
+                    self.caught_up = True
+                    await self.queue.put((PREFETCHER_CAUGHT_UP, ))
+                return False
 
         self.refill_event.clear()
         return True
@@ -138,7 +202,7 @@ class Prefetcher(object):
 class HeaderSource(object):
 
     def __init__(self, db):
-        self.hashes = db.fs_block_hashes
+        self.hashes = db.block_hashes
 
 
 class ChainError(Exception):
@@ -173,14 +237,22 @@ class BlockProcessor(electrumx.server.db.DB):
         # Header merkle cache
         self.merkle = Merkle()
         self.header_mc = None
+        # Map of height to header hash of recently processed blocks
+        self.recent_hashes = {}
 
         # Caches of unflushed items.
         self.headers = []
-        self.tx_hashes = []
+        self.tx_hashes = bytearray()
         self.undo_infos = []
 
+        # Raw blocks are written in the background, in order.  This is
+        # the future of the pending write, if any.
+        self.raw_block_writer = ThreadPoolExecutor(max_workers=1)
+        self.raw_block_write = None
+
         # UTXO cache
         self.utxo_cache = {}
+        self.flushed_utxos = {}
         self.db_deletes = []
 
         # If the lock is successfully acquired, in-memory chain state
@@ -215,12 +287,15 @@ class BlockProcessor(electrumx.server.db.DB):
                   for n, raw_block in enumerate(raw_blocks)]
         headers = [block.header for block in blocks]
         hprevs = [self.coin.header_prevhash(h) for h in headers]
-        chain = [self.tip] + [self.coin.header_hash(h) for h in headers[:-1]]
+        hashes = [self.coin.header_hash(h) for h in headers]
+        chain = [self.tip] + hashes[:-1]
 
         if hprevs == chain:
             start = time.time()
             async with self.state_lock:
-                await self.tasks.run_in_thread(self.advance_blocks, blocks)
+                await self.tasks.run_in_thread(self.advance_blocks, blocks,
+                                               hashes)
+                self.cache_recent_hashes(first, hashes)
             if not self.first_sync:
                 s = '' if len(blocks) == 1 else 's'
                 self.logger.info('processed {:,d} block{} in {:.1f}s'
@@ -255,7 +330,8 @@ class BlockProcessor(electrumx.server.db.DB):
         async def get_raw_blocks(last_height, hex_hashes):
             heights = range(last_height, last_height - len(hex_hashes), -1)
             try:
-                blocks = [self.read_raw_block(height) for height in heights]
+                blocks = await self.tasks.run_in_thread(self.read_raw_blocks,
+                                                        heights)
                 self.logger.info(f'read {len(blocks)} blocks from disk')
                 return blocks
             except Exception:
@@ -264,14 +340,13 @@ class BlockProcessor(electrumx.server.db.DB):
         start, hashes = await self.reorg_hashes(count)
         # Reverse and convert to hex strings.
         hashes = [hash_to_hex_str(hash) for hash in reversed(hashes)]
-        if isinstance(count, int):
-            last = start + count - 1
-        else:
-            last = start
+        last = start + len(hashes) - 1
         for hex_hashes in chunks(hashes, 50):
             raw_blocks = await get_raw_blocks(last, hex_hashes)
             async with self.state_lock:
                 await self.tasks.run_in_thread(self.backup_blocks, raw_blocks)
+                for height in range(last, self.height, -1):
+                    self.recent_hashes.pop(height, None)
             last -= len(raw_blocks)
         # Truncate header_mc: header count is 1 more than the height
         self.header_mc.truncate(self.height + 1)
@@ -298,9 +373,12 @@ class BlockProcessor(electrumx.server.db.DB):
             start = self.height - 1
             count = 1
             while start > 0:
-                hashes = self.fs_block_hashes(start, count)
+                # Read our hashes while waiting for the daemon's
+                hashes, d_hex_hashes = await asyncio.gather(
+                    self.tasks.run_in_thread(self.block_hashes,
+                                             start, count),
+                    self.daemon.block_hex_hashes(start, count))
                 hex_hashes = [hash_to_hex_str(hash) for hash in hashes]
-                d_hex_hashes = await self.daemon.block_hex_hashes(start, count)
                 n = diff_pos(hex_hashes, d_hex_hashes)
                 if n > 0:
                     start += n
@@ -317,7 +395,30 @@ class BlockProcessor(electrumx.server.db.DB):
                          'heights {:,d}-{:,d}'
                          .format(count, s, start, start + count - 1))
 
-        return start, self.fs_block_hashes(start, count)
+        return start, self.block_hashes(start, count)
+
+    def cache_recent_hashes(self, first, hashes):
+        '''Remember the header hashes of blocks just processed, forgetting
+        those too deep to be reorganised.'''
+        recent = self.recent_hashes
+        for height, hash in enumerate(hashes, start=first):
+            recent[height] = hash
+        limit = self.env.reorg_limit
+        for height in range(first - limit, self.height - limit + 1):
+            recent.pop(height, None)
+
+    def block_hashes(self, height, count):
+        '''Return the header hashes of count blocks starting at height.
+
+        Recently processed blocks are taken from memory; the rest are
+        read from disk and hashed.'''
+        recent = self.recent_hashes
+        end = height + count
+        start = end
+        while start > height and start - 1 in recent:
+            start -= 1
+        hashes = self.fs_block_hashes(height, start - height)
+        return hashes + [recent[n] for n in range(start, end)]
 
     def flush_state(self, batch):
         '''Flush chain state to the batch.'''
@@ -342,6 +443,7 @@ class BlockProcessor(electrumx.server.db.DB):
         History is always flushed.  UTXOs are flushed if flush_utxos.'''
         if self.height == self.db_height:
             self.assert_flushed()
+            self.wait_for_raw_block_writes()
             return
 
         flush_start = time.time()
@@ -361,6 +463,9 @@ class BlockProcessor(electrumx.server.db.DB):
             self.logger.info('flushed history in {:.1f}s for {:,d} addrs'
                              .format(time.time() - fs_end, hashX_count))
 
+        # The undo information committed below needs its raw blocks
+        self.wait_for_raw_block_writes()
+
         # Flush state last as it reads the wall time.
         with self.utxo_db.write_batch() as batch:
             if flush_utxos:
@@ -400,6 +505,13 @@ class BlockProcessor(electrumx.server.db.DB):
                              .format(formatted_time(self.wall_time),
                                      formatted_time(tx_est / this_tx_per_sec)))
 
+    def wait_for_raw_block_writes(self):
+        '''Wait for raw block writes to complete.  Propagates any
+        exception raised writing them.'''
+        if self.raw_block_write:
+            self.raw_block_write.result()
+            self.raw_block_write = None
+
     def fs_flush(self):
         '''Flush the things stored on the filesystem.'''
         assert self.fs_height + len(self.headers) == self.height
@@ -408,7 +520,7 @@ class BlockProcessor(electrumx.server.db.DB):
         self.fs_update(self.fs_height, self.headers, self.tx_hashes)
         self.fs_height = self.height
         self.fs_tx_count = self.tx_count
-        self.tx_hashes = []
+        self.tx_hashes = bytearray()
         self.headers = []
 
     def backup_flush(self):
@@ -449,11 +561,13 @@ class BlockProcessor(electrumx.server.db.DB):
 
     def check_cache_size(self):
         '''Flush a cache if it gets too big.'''
-        # Good average estimates based on traversal of subobjects and
-        # requesting size from Python (see deep_getsizeof).
+        # Containers report the size of their own tables; add the
+        # bytes objects they hold.  This agrees with deep_getsizeof.
         one_MB = 1000*1000
-        utxo_cache_size = len(self.utxo_cache) * 205
-        db_deletes_size = len(self.db_deletes) * 57
+        utxo_cache_size = (getsizeof(self.utxo_cache)
+                           + len(self.utxo_cache) * UTXO_ITEM_SIZE)
+        db_deletes_size = (getsizeof(self.db_deletes)
+                           + len(self.db_deletes) * DB_DELETE_SIZE)
         hist_cache_size = self.history.unflushed_memsize()
         # Roughly ntxs * 32 + nblocks * 42
         tx_hash_size = ((self.tx_count - self.fs_tx_count) * 32
@@ -461,6 +575,11 @@ class BlockProcessor(electrumx.server.db.DB):
         utxo_MB = (db_deletes_size + utxo_cache_size) // one_MB
         hist_MB = (hist_cache_size + tx_hash_size) // one_MB
 
+        # Flushed UTXOs only get the cache memory nothing else is using
+        self.trim_flushed_utxos(self.cache_MB * one_MB - utxo_cache_size
+                                - db_deletes_size - hist_cache_size
+                                - tx_hash_size)
+
         self.logger.info('our height: {:,d} daemon: {:,d} '
                          'UTXOs {:,d}MB hist {:,d}MB'
                          .format(self.height, self.daemon.cached_height(),
@@ -471,25 +590,56 @@ class BlockProcessor(electrumx.server.db.DB):
         if utxo_MB + hist_MB >= self.cache_MB or hist_MB >= self.cache_MB // 5:
             self.flush(utxo_MB >= self.cache_MB * 4 // 5)
 
-    def advance_blocks(self, blocks):
-        '''Synchronously advance the blocks.
+    def flushed_utxos_room(self):
+        '''Return the memory flushed UTXOs may use when nothing else is.
+
+        When serving every block is flushed, so the flushed UTXOs of a
+        few hundred recent blocks give most of the benefit and the rest
+        of the memory is better left to sessions.'''
+        share = 4 if self.utxo_db.for_sync else 1
+        return self.cache_MB * 1000 * 1000 * share // 5
+
+    def trim_flushed_utxos(self, size):
+        '''Evict the oldest flushed UTXOs from memory so the remainder
+        take up no more than size bytes.'''
+        flushed_utxos = self.flushed_utxos
+        count = len(flushed_utxos)
+        if not count:
+            return
+        entry_size = UTXO_ITEM_SIZE + getsizeof(flushed_utxos) // count
+        excess = count - max(size, 0) // entry_size
+        if excess > 0:
+            for key in list(islice(flushed_utxos, excess)):
+                del flushed_utxos[key]
+
+    def advance_blocks(self, blocks, hashes):
+        '''Synchronously advance the blocks.  hashes are their header
+        hashes.
 
         It is already verified they correctly connect onto our tip.
         '''
         min_height = self.min_undo_height(self.daemon.cached_height())
         height = self.height
+        self.prefetch_utxos(blocks)
+        raw_blocks = []
 
         for block in blocks:
             height += 1
             undo_info = self.advance_txs(block.transactions)
             if height >= min_height:
                 self.undo_infos.append((undo_info, height))
-                self.write_raw_block(block.raw, height)
+                raw_blocks.append((block.raw, height))
+
+        if raw_blocks:
+            # Only one write is pending at a time so no error is lost
+            self.wait_for_raw_block_writes()
+            self.raw_block_write = self.raw_block_writer.submit(
+                self.write_raw_blocks, raw_blocks)
 
         headers = [block.header for block in blocks]
         self.height = height
         self.headers.extend(headers)
-        self.tip = self.coin.header_hash(headers[-1])
+        self.tip = hashes[-1]
 
         # If caught up, flush everything as client queries are
         # performed on the DB.
@@ -500,17 +650,49 @@ class BlockProcessor(electrumx.server.db.DB):
                 self.check_cache_size()
                 self.next_cache_check = time.time() + 30
 
-    def advance_txs(self, txs):
-        self.tx_hashes.append(b''.join(tx_hash for tx, tx_hash in txs))
+    def prefetch_utxos(self, blocks):
+        '''Read the UTXOs spent by the blocks from the DB into memory.
+
+        Doing the reads in key order in one pass, rather than
+        interleaved with processing the transactions, makes much better
+        use of the DB's block cache.
+        '''
+        utxo_cache = self.utxo_cache
+        flushed_utxos = self.flushed_utxos
+        packed_idx = PACKED_IDX
+        created = set(tx_hash for block in blocks
+                      for tx, tx_hash in block.transactions)
+        prevouts = set()
 
+        for block in blocks:
+            for tx, tx_hash in block.transactions:
+                inputs = tx.inputs
+                if not (inputs and inputs[0].prev_idx == COINBASE_IDX
+                        and tx.is_coinbase):
+                    for txin in inputs:
+                        prev_hash = txin.prev_hash
+                        if prev_hash not in created:
+                            key = prev_hash + packed_idx[txin.prev_idx]
+                            if key not in utxo_cache:
+                                prevouts.add(key)
+
+        read_utxo = self.read_utxo
+        for key in sorted(prevouts.difference(flushed_utxos)):
+            cache_value = read_utxo(key[:-2], key[-2:])
+            if cache_value:
+                flushed_utxos[key] = cache_value
+
+    def advance_txs(self, txs):
         # Use local vars for speed in the loops
-        undo_info = []
+        undo_info = bytearray()
+        tx_hashes = self.tx_hashes
         tx_num = self.tx_count
         script_hashX = self.coin.hashX_from_script
-        s_pack = pack
+        packed_idx = PACKED_IDX
+        s_pack_utxo_value = pack_utxo_value
         put_utxo = self.utxo_cache.__setitem__
+        pop_utxo = self.utxo_cache.pop
         spend_utxo = self.spend_utxo
-        undo_info_append = undo_info.append
         update_touched = self.touched.update
         hashXs_by_tx = []
         append_hashXs = hashXs_by_tx.append
@@ -518,13 +700,20 @@ class BlockProcessor(electrumx.server.db.DB):
         for tx, tx_hash in txs:
             hashXs = []
             append_hashX = hashXs.append
-            tx_numb = s_pack('<I', tx_num)
-
-            # Spend the inputs
-            if not tx.is_coinbase:
-                for txin in tx.inputs:
-                    cache_value = spend_utxo(txin.prev_hash, txin.prev_idx)
-                    undo_info_append(cache_value)
+            tx_hashes += tx_hash
+
+            # Spend the inputs.  Most spends are of UTXOs in the cache;
+            # pop those directly and only make the spend_utxo call on
+            # a miss.
+            inputs = tx.inputs
+            if not (inputs and inputs[0].prev_idx == COINBASE_IDX
+                    and tx.is_coinbase):
+                for txin in inputs:
+                    prev_hash, prev_idx = txin.prev_hash, txin.prev_idx
+                    cache_value = (pop_utxo(prev_hash + packed_idx[prev_idx],
+                                            None)
+                                   or spend_utxo(prev_hash, prev_idx))
+                    undo_info += cache_value
                     append_hashX(cache_value[:-12])
 
             # Add the new UTXOs
@@ -533,8 +722,8 @@ class BlockProcessor(electrumx.server.db.DB):
                 hashX = script_hashX(txout.pk_script)
                 if hashX:
                     append_hashX(hashX)
-                    put_utxo(tx_hash + s_pack('<H', idx),
-                             hashX + tx_numb + s_pack('<Q', txout.value))
+                    put_utxo(tx_hash + packed_idx[idx],
+                             s_pack_utxo_value(hashX, tx_num, txout.value))
 
             append_hashXs(hashXs)
             update_touched(hashXs)
@@ -584,7 +773,7 @@ class BlockProcessor(electrumx.server.db.DB):
         n = len(undo_info)
 
         # Use local vars for speed in the loops
-        s_pack = pack
+        packed_idx = PACKED_IDX
         put_utxo = self.utxo_cache.__setitem__
         spend_utxo = self.spend_utxo
         script_hashX = self.coin.hashX_from_script
@@ -601,11 +790,13 @@ class BlockProcessor(electrumx.server.db.DB):
                     touched.add(cache_value[:-12])
 
             # Restore the inputs
-            if not tx.is_coinbase:
-                for txin in reversed(tx.inputs):
+            inputs = tx.inputs
+            if not (inputs and inputs[0].prev_idx == COINBASE_IDX
+                    and tx.is_coinbase):
+                for txin in reversed(inputs):
                     n -= undo_entry_len
                     undo_item = undo_info[n:n + undo_entry_len]
-                    put_utxo(txin.prev_hash + s_pack('<H', txin.prev_idx),
+                    put_utxo(txin.prev_hash + packed_idx[txin.prev_idx],
                              undo_item)
                     touched.add(undo_item[:-12])
 
@@ -625,20 +816,28 @@ class BlockProcessor(electrumx.server.db.DB):
       Key:    TX_HASH + TX_IDX           (32 + 2 = 34 bytes)
       Value:  HASHX + TX_NUM + VALUE     (11 + 4 + 8 = 23 bytes)
 
-    That's 57 bytes of raw data in-memory.  Python dictionary overhead
-    means each entry actually uses about 205 bytes of memory.  So
-    almost 5 million UTXOs can fit in 1GB of RAM.  There are
+    That's 57 bytes of raw data in-memory.  Python object and
+    dictionary overhead means each entry actually uses 150 to 180
+    bytes of memory, depending on how full the dictionary's table is.
+    So almost 6 million UTXOs can fit in 1GB of RAM.  There are
     approximately 42 million UTXOs on bitcoin mainnet at height
     433,000.
 
+    When the cache is flushed its UTXOs are not discarded but moved to
+    a second dictionary of flushed UTXOs, which mirrors entries that
+    are on disk.  Flushed UTXOs are retained, oldest evicted first,
+    using whatever cache memory unflushed state does not need.
+
     Semantics:
 
       add:   Add it to the cache dictionary.
 
-      spend: Remove it if in the cache dictionary.  Otherwise it's
-             been flushed to the DB.  Each UTXO is responsible for two
-             entries in the DB.  Mark them for deletion in the next
-             cache flush.
+      spend: Remove it if in the cache dictionary; it was never
+             written to the DB.  Otherwise it's been flushed to the
+             DB.  Each UTXO is responsible for two entries in the DB.
+             Mark them for deletion in the next cache flush, reading
+             them from the DB only if the UTXO is not in the flushed
+             UTXO dictionary.
 
     The UTXO database format has to be able to do two things efficiently:
 
@@ -674,20 +873,38 @@ class BlockProcessor(electrumx.server.db.DB):
         corruption.
         '''
         # Fast track is it being in the cache
-        idx_packed = pack('<H', tx_idx)
-        cache_value = self.utxo_cache.pop(tx_hash + idx_packed, None)
+        idx_packed = PACKED_IDX[tx_idx]
+        cache_key = tx_hash + idx_packed
+        cache_value = self.utxo_cache.pop(cache_key, None)
         if cache_value:
             return cache_value
 
-        # Spend it from the DB.
+        # Next is it being flushed but still in memory, otherwise
+        # spend it from the DB.
+        cache_value = (self.flushed_utxos.pop(cache_key, None)
+                       or self.read_utxo(tx_hash, idx_packed))
+        if cache_value:
+            # Remove both DB entries for this UTXO
+            # suffix = tx_idx + tx_num
+            suffix = idx_packed + cache_value[-12:-8]
+            self.db_deletes.append(b'h' + tx_hash[:4] + suffix)
+            self.db_deletes.append(b'u' + cache_value[:-12] + suffix)
+            return cache_value
+
+        raise ChainError('UTXO {} / {:,d} not found in "h" table'
+                         .format(hash_to_hex_str(tx_hash), tx_idx))
 
+    def read_utxo(self, tx_hash, idx_packed):
+        '''Read a UTXO from the DB and return its cache value of hashX +
+        tx_num + value, or None if it is not found.'''
         # Key: b'h' + compressed_tx_hash + tx_idx + tx_num
         # Value: hashX
         prefix = b'h' + tx_hash[:4] + idx_packed
-        candidates = {db_key: hashX for db_key, hashX
-                      in self.utxo_db.iterator(prefix=prefix)}
 
-        for hdb_key, hashX in candidates.items():
+        # Usually there is a single candidate, which must be it
+        candidates = list(self.utxo_db.iterator(prefix=prefix))
+
+        for hdb_key, hashX in candidates:
             tx_num_packed = hdb_key[-4:]
 
             if len(candidates) > 1:
@@ -699,16 +916,11 @@ class BlockProcessor(electrumx.server.db.DB):
 
             # Key: b'u' + address_hashX + tx_idx + tx_num
             # Value: the UTXO value as a 64-bit unsigned integer
-            udb_key = b'u' + hashX + hdb_key[-6:]
-            utxo_value_packed = self.utxo_db.get(udb_key)
+            utxo_value_packed = self.utxo_db.get(b'u' + hashX + hdb_key[-6:])
             if utxo_value_packed:
-                # Remove both entries for this UTXO
-                self.db_deletes.append(hdb_key)
-                self.db_deletes.append(udb_key)
                 return hashX + tx_num_packed + utxo_value_packed
 
-        raise ChainError('UTXO {} / {:,d} not found in "h" table'
-                         .format(hash_to_hex_str(tx_hash), tx_idx))
+        return None
 
     def flush_utxos(self, batch):
         '''Flush the cached DB writes and UTXO set to the batch.'''
@@ -733,7 +945,9 @@ class BlockProcessor(electrumx.server.db.DB):
             suffix = cache_key[-2:] + cache_value[-12:-8]
             batch_put(b'h' + cache_key[:4] + suffix, hashX)
             batch_put(b'u' + hashX + suffix, cache_value[-8:])
+        self.flushed_utxos.update(self.utxo_cache)
         self.utxo_cache = {}
+        self.trim_flushed_utxos(self.flushed_utxos_room())
 
         # New undo information
         self.flush_undo_infos(batch_put, self.undo_infos)
@@ -754,11 +968,27 @@ class BlockProcessor(electrumx.server.db.DB):
 
     async def _process_queue(self):
         '''Loop forever processing enqueued work.'''
+        pending = None
         while True:
-            work, *args = await self.queue.get()
+            work, *args = pending or await self.queue.get()
+            pending = None
             if work == RAW_BLOCKS:
                 raw_blocks, first = args
+                # Batches queued while the last was being processed are
+                # merged so they are advanced in one go
+                size = sum(len(block) for block in raw_blocks)
+                while (not self.queue.empty()
+                       and size < self.prefetcher.min_cache_size // 2):
+                    item = self.queue.get_nowait()
+                    if (item[0] != RAW_BLOCKS
+                            or item[2] != first + len(raw_blocks)):
+                        pending = item
+                        break
+                    raw_blocks = raw_blocks + item[1]
+                    size += sum(len(block) for block in item[1])
                 await self.check_and_advance_blocks(raw_blocks, first)
+                if pending is None and self.queue.empty():
+                    self.prefetcher.starved()
             elif work == PREFETCHER_CAUGHT_UP:
                 self._caught_up_event.set()
                 # Initialise the notification framework
@@ -767,6 +997,50 @@ class BlockProcessor(electrumx.server.db.DB):
                 count, = args
                 await self.reorg_chain(count)
 
+    def populate_header_mc(self, length, header_mc=None):
+        '''Return a header merkle cache of the first length headers.
+
+        The complete segments of header_mc are reused if it has the
+        right depth, otherwise those stored in the DB if they apply.
+        '''
+        depth_higher = self.merkle.tree_depth(length) // 2
+        if header_mc and header_mc.depth_higher == depth_higher:
+            level = header_mc.level[:header_mc.length >> depth_higher]
+        else:
+            level = self.read_header_mc_level(length)
+        return MerkleCache(self.merkle, HeaderSource(self), length, level)
+
+    def read_header_mc_level(self, length):
+        '''Return the stored level of the header merkle cache, or None if
+        it is missing or does not suit a cache of length headers.
+
+        The level is only used if the hash of the last header it covers
+        is unchanged, which means all the headers before it are too.
+        '''
+        value = self.utxo_db.get(b'merkle')
+        depth_higher = self.merkle.tree_depth(length) // 2
+        if not value or value[0] != depth_higher:
+            return None
+        level = [value[n:n + 32] for n in range(33, len(value), 32)]
+        last = (len(level) << depth_higher) - 1
+        if last >= length or self.block_hashes(last, 1)[0] != value[1:33]:
+            return None
+        self.logger.info(f'read {len(level):,d} header merkle cache '
+                         f'segments from DB')
+        return level
+
+    def write_header_mc_level(self):
+        '''Store the complete segments of the header merkle cache level
+        together with the hash of the last header they cover.'''
+        header_mc = self.header_mc
+        count = header_mc.length >> header_mc.depth_higher
+        if count:
+            last = (count << header_mc.depth_higher) - 1
+            value = b''.join([bytes([header_mc.depth_higher]),
+                              self.block_hashes(last, 1)[0],
+                              *header_mc.level[:count]])
+            self.utxo_db.put(b'merkle', value)
+
     def _on_dbs_opened(self):
         # An incomplete compaction needs to be cancelled otherwise
         # restarting it will corrupt the history
@@ -799,19 +1073,43 @@ class BlockProcessor(electrumx.server.db.DB):
         self.worker_task = self.tasks.create_task(self._process_queue())
         # Wait until caught up
         await self._caught_up_event.wait()
-        # Flush everything but with first_sync->False state.
+        # Flush everything but with first_sync->False state.  Meanwhile
+        # populate the header merkle cache from the headers already on
+        # disk.
         first_sync = self.first_sync
         self.first_sync = False
-        self.flush(True)
+        header_mc = None
+        async with self.state_lock:
+            length = max(1, self.height - self.env.reorg_limit)
+            disk_length = min(length, self.db_height + 1)
+            flush = self.tasks.run_in_thread(self.flush, True)
+            if disk_length > 0:
+                # The flush must finish before the lock is released even
+                # if populating the cache fails
+                header_mc, flushed = await asyncio.gather(
+                    self.tasks.run_in_thread(self.populate_header_mc,
+                                             disk_length), flush,
+                    return_exceptions=True)
+                for result in (flushed, header_mc):
+                    if isinstance(result, BaseException):
+                        raise result
+            else:
+                await flush
         if first_sync:
             self.logger.info(f'{electrumx.version} synced to '
                              f'height {self.height:,d}')
         # Reopen for serving
         await self.open_for_serving()
-
-        # Populate the header merkle cache
-        length = max(1, self.height - self.env.reorg_limit)
-        self.header_mc = MerkleCache(self.merkle, HeaderSource(self), length)
+        async with self.state_lock:
+            # Copy so the dictionary's table shrinks too
+            self.trim_flushed_utxos(self.flushed_utxos_room())
+            self.flushed_utxos = dict(self.flushed_utxos)
+
+        # Complete the header merkle cache
+        if header_mc is None or header_mc.length < length:
+            header_mc = self.populate_header_mc(length, header_mc)
+        self.header_mc = header_mc
+        self.write_header_mc_level()
         self.logger.info('populated header merkle cache')
 
     def force_chain_reorg(self, count):
@@ -837,4 +1135,4 @@ class BlockProcessor(electrumx.server.db.DB):
                 # Shut down block processing
                 self.worker_task.cancel()
                 self.logger.info('flushing to DB for a clean shutdown...')
-                self.flush(True)
+                await self.tasks.run_in_thread(self.flush, True)
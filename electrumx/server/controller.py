@@ -96,6 +96,7 @@ class Controller(ServerBase):
 
         notifications = Notifications()
         daemon = env.coin.DAEMON(env)
+        self.daemon = daemon
         BlockProcessor = env.coin.BLOCK_PROCESSOR
         self.bp = BlockProcessor(env, self.tasks, daemon, notifications)
         self.mempool = MemPool(env.coin, self.tasks, daemon, notifications,
@@ -127,3 +128,4 @@ class Controller(ServerBase):
         await self.chain_state.shutdown()
         # Cancel all tasks; this shuts down the peer manager and prefetcher
         await self.tasks.cancel_all(wait=True)
+        await self.daemon.close()
@@ -47,6 +47,7 @@ class Daemon(object):
         self.last_error_time = 0
         self.req_id = 0
         self._available_rpcs = {}  # caches results for _is_rpc_available()
+        self.session = None
 
     def next_req_id(self):
         '''Retrns the next request ID.'''
@@ -80,19 +81,33 @@ class Daemon(object):
         return False
 
     def client_session(self):
-        '''An aiohttp client session.'''
-        return aiohttp.ClientSession()
+        '''The aiohttp client session, created on first use.
+
+        It is kept for the life of the daemon so connections are reused
+        rather than opened for each request.  Idle connections are
+        dropped before bitcoind's default 30 second server timeout.
+        '''
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(keepalive_timeout=20)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        '''Close the client session and its connections.'''
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
     async def _send_data(self, data):
         async with self.workqueue_semaphore:
-            async with self.client_session() as session:
-                async with session.post(self.url(), data=data) as resp:
-                    # If bitcoind can't find a tx, for some reason
-                    # it returns 500 but fills out the JSON.
-                    # Should still return 200 IMO.
-                    if resp.status in (200, 404, 500):
-                        return await resp.json()
-                    return (resp.status, resp.reason)
+            session = self.client_session()
+            async with session.post(self.url(), data=data) as resp:
+                # If bitcoind can't find a tx, for some reason
+                # it returns 500 but fills out the JSON.
+                # Should still return 200 IMO.
+                if resp.status in (200, 404, 500):
+                    return await resp.json()
+                return (resp.status, resp.reason)
 
     async def _send(self, payload, processor):
         '''Send a payload to be converted to JSON.
@@ -150,8 +150,9 @@ class DB(object):
         return self.dynamic_header_offset(height + 1)\
                - self.dynamic_header_offset(height)
 
-    def fs_update(self, fs_height, headers, block_tx_hashes):
+    def fs_update(self, fs_height, headers, tx_hashes):
         '''Write headers, the tx_count array and block tx hashes to disk.
+        tx_hashes is the concatenated hashes of the blocks' txs.
 
         Their first height is fs_height.  No recorded DB state is
         updated.  These arrays are all append only, so in a crash we
@@ -164,11 +165,9 @@ class DB(object):
         cur_tx_count = self.tx_counts[-1] if self.tx_counts else 0
         txs_done = cur_tx_count - prior_tx_count
 
-        assert len(block_tx_hashes) == blocks_done
         assert len(self.tx_counts) == new_height + 1
-        hashes = b''.join(block_tx_hashes)
-        assert len(hashes) % 32 == 0
-        assert len(hashes) // 32 == txs_done
+        assert len(tx_hashes) % 32 == 0
+        assert len(tx_hashes) // 32 == txs_done
 
         # Write the headers, tx counts, and tx hashes
         offset = self.header_offset(height_start)
@@ -178,7 +177,7 @@ class DB(object):
         self.tx_counts_file.write(offset,
                                   self.tx_counts[height_start:].tobytes())
         offset = prior_tx_count * 32
-        self.hashes_file.write(offset, hashes)
+        self.hashes_file.write(offset, tx_hashes)
 
     def read_headers(self, start_height, count):
         '''Requires start_height >= 0, count >= 0.  Reads as many headers as
@@ -250,9 +249,11 @@ class DB(object):
         return self.utxo_db.get(self.undo_key(height))
 
     def flush_undo_infos(self, batch_put, undo_infos):
-        '''undo_infos is a list of (undo_info, height) pairs.'''
+        '''undo_infos is a list of (undo_info, height) pairs.  Each
+        undo_info is the concatenated values of the UTXOs spent by the
+        block.'''
         for undo_info, height in undo_infos:
-            batch_put(self.undo_key(height), b''.join(undo_info))
+            batch_put(self.undo_key(height), bytes(undo_info))
 
     def raw_block_prefix(self):
         return 'meta/block'
@@ -266,16 +267,23 @@ class DB(object):
         with util.open_file(self.raw_block_path(height)) as f:
             return f.read(-1)
 
-    def write_raw_block(self, block, height):
-        '''Write a raw block to disk.'''
-        with util.open_truncate(self.raw_block_path(height)) as f:
-            f.write(block)
+    def read_raw_blocks(self, heights):
+        '''Returns a list of raw blocks read from disk at the given
+        heights.  Raises FileNotFoundError if a block isn't on-disk.'''
+        return [self.read_raw_block(height) for height in heights]
+
+    def write_raw_blocks(self, blocks):
+        '''Write a sequence of (raw_block, height) pairs to disk.'''
+        for block, height in blocks:
+            with util.open_truncate(self.raw_block_path(height)) as f:
+                f.write(block)
         # Delete old blocks to prevent them accumulating
-        try:
-            del_height = self.min_undo_height(height) - 1
-            os.remove(self.raw_block_path(del_height))
-        except FileNotFoundError:
-            pass
+        for block, height in blocks:
+            try:
+                del_height = self.min_undo_height(height) - 1
+                os.remove(self.raw_block_path(del_height))
+            except FileNotFoundError:
+                pass
 
     def clear_excess_undo_info(self):
         '''Clear excess undo info.  Only most recent N are kept.'''
@@ -172,6 +172,19 @@ def test_merkle_cache():
                 assert root == root2
 
 
+def test_merkle_cache_from_level():
+    source = Source(64)
+    for length in range(1, 65):
+        cache = MerkleCache(merkle, source, length)
+        segments = length >> cache.depth_higher
+        for count in range(segments + 1):
+            cache2 = MerkleCache(merkle, source, length, cache.level[:count])
+            assert cache2.level == cache.level
+            for index in range(0, length, 3):
+                assert (cache2.branch_and_root(length, index) ==
+                        cache.branch_and_root(length, index))
+
+
 def test_merkle_cache_extension():
     source = Source(64)
     for length in range(14, 18):
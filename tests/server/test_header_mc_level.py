@@ -0,0 +1,81 @@
+# Tests of storing the header merkle cache level in server/block_processor.py
+
+import asyncio
+from os import environ, urandom
+
+from electrumx.lib.merkle import MerkleCache
+from electrumx.server.env import Env
+from electrumx.server.block_processor import BlockProcessor, HeaderSource
+
+
+def set_hashes(bp, length):
+    # Hashes of recent blocks are served from memory
+    bp.recent_hashes = {height: urandom(32) for height in range(length)}
+
+
+def write_level(bp, length):
+    bp.header_mc = MerkleCache(bp.merkle, HeaderSource(bp), length)
+    bp.write_header_mc_level()
+    return bp.header_mc
+
+
+def check_read_back(bp):
+    assert bp.read_header_mc_level(100) is None
+    set_hashes(bp, 300)
+    # 6 complete segments of 16 hashes, covering heights 0 to 95
+    header_mc = write_level(bp, 100)
+    level = bp.read_header_mc_level(100)
+    assert len(level) == 6
+    assert level == header_mc.level[:6]
+    # A longer cache of the same depth can use it
+    assert bp.read_header_mc_level(200) == level
+    # Headers after those it covers do not matter
+    bp.recent_hashes[99] = urandom(32)
+    assert bp.read_header_mc_level(100) == level
+    # The level gives the same proofs as a fresh cache
+    header_mc = MerkleCache(bp.merkle, HeaderSource(bp), 100, level)
+    fresh = MerkleCache(bp.merkle, HeaderSource(bp), 100)
+    for index in range(100):
+        assert (header_mc.branch_and_root(100, index)
+                == fresh.branch_and_root(100, index))
+
+
+def check_depth_higher(bp):
+    set_hashes(bp, 300)
+    write_level(bp, 100)
+    assert bp.read_header_mc_level(100) is not None
+    # 300 hashes have segments of 32 rather than 16
+    assert bp.read_header_mc_level(300) is None
+    # even if the header its 6 segments would end at has the same hash
+    bp.recent_hashes[191] = bp.recent_hashes[95]
+    assert bp.read_header_mc_level(300) is None
+    # Fewer hashes than the level covers
+    assert bp.read_header_mc_level(90) is None
+
+
+def check_reorg(bp):
+    set_hashes(bp, 300)
+    write_level(bp, 100)
+    assert bp.read_header_mc_level(100) is not None
+    # A new last covered header means the headers before it may differ
+    bp.recent_hashes[95] = urandom(32)
+    assert bp.read_header_mc_level(100) is None
+
+
+async def run_test(db_dir):
+    environ.clear()
+    environ['DB_DIRECTORY'] = db_dir
+    environ['DAEMON_URL'] = ''
+    environ['COIN'] = 'BitcoinCash'
+    bp = BlockProcessor(Env(), None, None, None)
+    await bp.open_for_serving()
+
+    check_read_back(bp)
+    check_depth_higher(bp)
+    check_reorg(bp)
+
+
+def test_header_mc_level(tmpdir):
+    db_dir = str(tmpdir)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_test(db_dir))
@@ -0,0 +1,73 @@
+# Tests of the block prefetcher in server/block_processor.py
+
+import asyncio
+
+from electrumx.server.block_processor import (Prefetcher, RAW_BLOCKS,
+                                              PREFETCHER_CAUGHT_UP)
+
+
+class Daemon(object):
+    '''A daemon serving height blocks of block_size bytes each.'''
+
+    def __init__(self, height, block_size):
+        self._height = height
+        self.block_size = block_size
+
+    async def height(self):
+        return self._height
+
+    async def block_hex_hashes(self, first, count):
+        return ['{:064x}'.format(height)
+                for height in range(first, first + count)]
+
+    async def raw_blocks(self, hex_hashes):
+        return [bytes(self.block_size) for hex_hash in hex_hashes]
+
+
+async def sync(daemon, starved=True):
+    '''Process prefetched blocks until caught up, and return their
+    heights.'''
+    queue = asyncio.Queue()
+    prefetcher = Prefetcher(daemon, None, queue)
+    main_loop = asyncio.ensure_future(prefetcher.main_loop())
+    await prefetcher.reset_height(0)
+    heights = []
+    try:
+        while True:
+            work, *args = await asyncio.wait_for(queue.get(), 10)
+            if work == PREFETCHER_CAUGHT_UP:
+                return heights
+            assert work == RAW_BLOCKS
+            blocks, first = args
+            heights.extend(range(first, first + len(blocks)))
+            prefetcher.processing_blocks(blocks)
+            if starved and queue.empty():
+                prefetcher.starved()
+    finally:
+        main_loop.cancel()
+
+
+def run_sync(daemon, starved=True):
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(sync(daemon, starved))
+
+
+def test_prefetch_small_blocks():
+    daemon = Daemon(1200, 1000)
+    assert run_sync(daemon) == list(range(1, 1201))
+
+
+def test_prefetch_large_blocks():
+    # Blocks over half of the minimum cache size must still be fetched
+    daemon = Daemon(40, 6 * 1024 * 1024)
+    assert run_sync(daemon, starved=False) == list(range(1, 41))
+    assert run_sync(daemon) == list(range(1, 41))
+
+
+def test_starved_refills():
+    prefetcher = Prefetcher(Daemon(10, 1000), None, asyncio.Queue())
+    min_cache_size = prefetcher.min_cache_size
+    prefetcher.refill_event.clear()
+    prefetcher.starved()
+    assert prefetcher.min_cache_size == min_cache_size * 2
+    assert prefetcher.refill_event.is_set()